@@ -8,10 +8,26 @@ MIT License. See the project's LICENSE file.
 
 import os
 import platform
+import re
 import pathlib
 import shutil
+import sys
+import subprocess
+import concurrent.futures
+import collections
+import csv
 import numpy as np
-import pandas as pd
+
+
+_IS_WINDOWS = platform.system() == 'Windows'
+_IS_LINUX = platform.system() == 'Linux'
+_EXE_SUFFIX = ".exe" if _IS_WINDOWS else ""
+
+_TEMPLATE_FOLDER = pathlib.Path(__file__).parent.absolute() / "templates"
+
+# The .mos templates are read once at import, they are only written out with the placeholders replaced
+_OMC_TEMPLATES = {name: (_TEMPLATE_FOLDER / "omc" / "{}.template".format(name)).read_text()
+                  for name in ("model_import.mos", "model_simulate.mos")}
 
 
 class RegressionTest:
@@ -20,6 +36,10 @@ class RegressionTest:
     Creates OpenModelica-compatible .mos scripts to import and simulate the model with .csv output.
     The .csv output is then compared against a reference result, possibly only on a subset of columns.
     """
+    # Parsed reference results, shared by all instances and keyed by (path, modification time, columns)
+    _REF_CACHE = collections.OrderedDict()
+    _REF_CACHE_SIZE = 32
+
     def __init__(self, package_folder, model_in_package, result_folder, tool="omc"):
         """
         Constructor of the RegresssionTest class.
@@ -38,21 +58,38 @@ class RegressionTest:
             RegressionTest will search the PATH variable for omc and will execute the tests if found. 
         """
 
-        self.template_folder_path = pathlib.Path(__file__).parent.absolute() / "templates"
+        self.template_folder_path = _TEMPLATE_FOLDER
         self.package_folder_path = pathlib.Path(package_folder).absolute()
         self.model_in_package = model_in_package
         self.result_folder_path = pathlib.Path(result_folder).absolute()
-        self.initial_cwd = os.getcwd()
 
         if tool != None:
             self.tools = [tool]
         else:
-            self.tools = [tl for tl in ["omc"] if shutil.which(tl) != None]
+            self.tools = [tl for tl in ["omc"] if shutil.which(tl + _EXE_SUFFIX) != None]
+
+        # Resolve the simulation tool executables once, falling back to the plain name if not found in PATH
+        self._tool_paths = {tl: shutil.which(tl + _EXE_SUFFIX) or tl + _EXE_SUFFIX for tl in self.tools}
+
+        # Paths used on every test run depend only on the constructor arguments
+        self._result_folder = str(self.result_folder_path)
+        self._import_mos = str(self.result_folder_path / "model_import.mos")
+        self._simulate_mos = str(self.result_folder_path / "model_simulate.mos")
+        self._simulation_result = str(self.result_folder_path / self.model_in_package) + "_res.csv"
+        self._repl_dict = {"PACKAGE_FOLDER": self.package_folder_path.as_posix(),
+                           "RESULT_FOLDER": self.result_folder_path.as_posix(),
+                           "MODEL_IN_PACKAGE": self.model_in_package}
 
         self.result_folder_created = False
 
     @staticmethod
     def _ask_confirmation(question, max_asks=5):
+        # Without an interactive terminal nobody can answer, so do not wait for input and decline
+        if sys.stdin is None or not sys.stdin.isatty():
+            print("{} [yes|no] ".format(question))
+            print("No interactive terminal to answer, assuming no. ")
+            return False
+
         answer = None
 
         for q in range(0, max_asks):
@@ -72,21 +109,120 @@ class RegressionTest:
         return answer
 
     @staticmethod
-    def _replace_in_file(filename, repl_dict):
-        fhandle = open(str(filename), 'r')
-        contents = fhandle.read()
-        fhandle.close()
+    def _replace_placeholders(contents, repl_dict):
+        if repl_dict:
+            # Replace all placeholders in a single scan, longest first in case one is a prefix of another
+            pattern = re.compile("|".join(re.escape(k) for k in sorted(repl_dict, key=len, reverse=True)))
+            contents = pattern.sub(lambda m: repl_dict[m.group(0)], contents)
+
+        return contents
+
+    @staticmethod
+    def _materialize(tpl_name, repl_dict, out_path):
+        """
+        Writes a cached .mos template with all placeholders replaced.
 
-        for k, v in repl_dict.items():
-            contents = contents.replace(k, v)
+        Parameters
+        ----------
+        tpl_name : str
+            Name of the template, e.g. model_import.mos
+        repl_dict : dict
+            Placeholders and the values they are replaced with
+        out_path : str
+            Path of the resulting .mos script
 
-        fhandle = open(str(filename), 'w')
-        fhandle.truncate()
-        fhandle.write(contents)
-        fhandle.close()
+        Returns
+        -------
+        out : None
+        """
+        with open(out_path, 'w') as fhandle:
+            fhandle.write(RegressionTest._replace_placeholders(_OMC_TEMPLATES[tpl_name], repl_dict))
 
         return
 
+    @staticmethod
+    def _read_csv_header(filename):
+        """
+        Reads the column names from the header line of a .csv result file.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the .csv file
+
+        Returns
+        -------
+        out : list
+            Column names in the order of the file
+        """
+        with open(str(filename), newline='') as fhandle:
+            return next(csv.reader(fhandle), [])
+
+    @staticmethod
+    def _load_res_csv(filename, header, cols):
+        """
+        Reads only the given columns of a .csv result file as floating point data. Result files
+        are expected to consist of a single header line followed by rows of numbers.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the .csv file
+        header : list
+            Column names of the file as returned by _read_csv_header
+        cols : list
+            Names of the columns (from the file header) to be read
+
+        Returns
+        -------
+        out : numpy.ndarray
+            2-D array with one column per entry of cols
+        """
+        col_index = {c: i for i, c in enumerate(header)}
+
+        missing_cols = [c for c in cols if c not in col_index]
+        if missing_cols:
+            raise ValueError("Columns {} not found in file {}. ".format(missing_cols, filename))
+
+        return np.loadtxt(str(filename), delimiter=',', skiprows=1, usecols=[col_index[c] for c in cols],
+                          dtype=np.float64, ndmin=2)
+
+    @classmethod
+    def _load_reference(cls, reference_result, header, cols):
+        """
+        Reads the given columns of a reference .csv file, reusing the data parsed by earlier calls
+        as long as the file has not been modified.
+
+        Parameters
+        ----------
+        reference_result : str
+            Path to the reference .csv file
+        header : list
+            Column names of the reference file as returned by _read_csv_header
+        cols : list
+            Names of the columns (from the file header) to be read
+
+        Returns
+        -------
+        out : numpy.ndarray
+            Read-only 2-D array with one column per entry of cols
+        """
+        key = (os.path.realpath(reference_result), os.stat(reference_result).st_mtime_ns, tuple(cols))
+
+        ref_arr = cls._REF_CACHE.get(key)
+        if ref_arr is None:
+            ref_arr = cls._load_res_csv(reference_result, header, cols)
+            # Cache hits return this very array, so protect it against modification by the caller
+            ref_arr.flags.writeable = False
+
+            cls._REF_CACHE[key] = ref_arr
+            if len(cls._REF_CACHE) > cls._REF_CACHE_SIZE:
+                cls._REF_CACHE.popitem(last=False)
+        else:
+            cls._REF_CACHE.move_to_end(key)
+
+        return ref_arr
+
     def _import_and_simulate(self):
         """
         Imports and simulates the model from the Modelica package specified in the constructor.
@@ -102,13 +238,9 @@ class RegressionTest:
             pathlib.Path.mkdir(self.result_folder_path)
             self.result_folder_created = True
 
-        pathlib.os.chdir(self.result_folder_path)
-
         # Run the scripts for import and simulation
         self._run_model()
 
-        pathlib.os.chdir(self.initial_cwd)
-
         return
 
     def compare_result(self, reference_result, precision=7, validated_cols=[]):
@@ -133,25 +265,87 @@ class RegressionTest:
         print("\nTesting model {}".format(self.model_in_package))
 
         self._import_and_simulate()
-        simulation_result = str(self.result_folder_path / self.model_in_package) + "_res.csv"
+        simulation_result = self._simulation_result
 
         print("Comparing simulation result {} and reference {}".format(simulation_result, reference_result))
 
-        ref_data = pd.read_csv(filepath_or_buffer=reference_result, delimiter=',')
-        result_data = pd.read_csv(filepath_or_buffer=simulation_result, delimiter=',')
-
-        # Determine common columns by comparing column headers
-        common_cols = set(ref_data.columns).intersection(set(result_data.columns))
+        # Determine common columns by comparing column headers only
+        ref_header = RegressionTest._read_csv_header(reference_result)
+        result_header = RegressionTest._read_csv_header(simulation_result)
+        result_header_lookup = dict.fromkeys(result_header)
+        common_cols = [c for c in ref_header if c in result_header_lookup]
 
         if not validated_cols:
             validated_cols = common_cols
 
-        for c in validated_cols:
-            print("Comparing column \"{}\"".format(c))
-            np.testing.assert_almost_equal(result_data[c].as_matrix(), ref_data[c].as_matrix(), precision)
+        cols = list(validated_cols)
+
+        # Parse only the columns that are actually compared
+        ref_arr = RegressionTest._load_reference(reference_result, ref_header, cols)
+        result_arr = RegressionTest._load_res_csv(simulation_result, result_header, cols)
+
+        print("Comparing columns {}".format(", ".join("\"{}\"".format(c) for c in cols)))
+
+        # Results on different time grids cannot be compared elementwise
+        if result_arr.shape[0] != ref_arr.shape[0]:
+            raise AssertionError("Simulation result has {} time steps, but reference has {}. ".format(
+                result_arr.shape[0], ref_arr.shape[0]))
+
+        try:
+            np.testing.assert_almost_equal(result_arr, ref_arr, precision)
+        except AssertionError as err:
+            # Report the column with the largest deviation to keep the diagnostics of a per-column check
+            if result_arr.shape == ref_arr.shape and result_arr.size > 0:
+                # Positions equal in both files (including NaN or infinity in both) do not deviate,
+                # whereas NaN in only one of them is the worst possible deviation
+                with np.errstate(invalid='ignore'):
+                    deviation = np.abs(result_arr - ref_arr)
+                matching = (result_arr == ref_arr) | (np.isnan(result_arr) & np.isnan(ref_arr))
+                deviation = np.where(matching, 0.0, np.nan_to_num(deviation, nan=np.inf))
+                worst_col = cols[int(np.argmax(deviation.max(axis=0)))]
+                raise AssertionError("Largest deviation in column \"{}\"\n{}".format(worst_col, err)) from err
+            raise
 
         return
 
+    @classmethod
+    def run_many(cls, tests, max_workers=os.cpu_count()):
+        """
+        Executes several regression tests in parallel, each in its own worker process.
+
+        Parameters
+        ----------
+        tests : list
+            List of tuples (tester, compare_kwargs) of a RegressionTest object and a dict of keyword
+            arguments passed to its compare_result method. The result folders of all testers must differ.
+        max_workers : int
+            Maximum number of regression tests executed at the same time (default=os.cpu_count())
+
+        Returns
+        -------
+        out : list
+            List with one entry per test in the order given by tests. The entry is None if the
+            test passed, otherwise the exception raised by compare_result.
+        """
+        tests = list(tests)
+
+        result_folders = [tester.result_folder_path for tester, _ in tests]
+        if len(set(result_folders)) != len(result_folders):
+            raise ValueError("Regression tests run in parallel require distinct result folders. ")
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_compare_result_worker, tester, compare_kwargs)
+                       for tester, compare_kwargs in tests]
+
+            outcomes = []
+            for (tester, _), future in zip(tests, futures):
+                # The worker operates on a copy of tester, so carry back whether it created the result folder
+                result_folder_created, error = future.result()
+                tester.result_folder_created = tester.result_folder_created or result_folder_created
+                outcomes.append(error)
+
+        return outcomes
+
     def cleanup(self, ask_confirmation=True):
         """
         USE WITH CARE
@@ -197,54 +391,60 @@ class RegressionTest:
 
         """
         for tool in self.tools:
-            tool_executable = tool
-            if platform.system() == 'Windows':
-                tool_executable += ".exe"
+            tool_executable = self._tool_paths[tool]
 
             print("Using simulation tool {}".format(tool_executable))
 
-            model_import_template = tool + "/model_import.mos.template"
-            model_simulate_template = tool + "/model_simulate.mos.template"
-            model_import_mos = "model_import.mos"
-            model_simulate_mos = "model_simulate.mos"
-            tool_output = tool + "_output.txt"
-
             if tool == "omc":
-                # Copy mos templates to result folder
-                shutil.copy(self.template_folder_path / model_import_template, self.result_folder_path / model_import_mos)
-                shutil.copy(self.template_folder_path / model_simulate_template, self.result_folder_path / model_simulate_mos)
-
-                # Modify the import template
-                repl_dict = {}
-                repl_dict["PACKAGE_FOLDER"] = str(self.package_folder_path.as_posix())
-                repl_dict["RESULT_FOLDER"] = str(self.result_folder_path.as_posix())
-                repl_dict["MODEL_IN_PACKAGE"] = self.model_in_package
+                # Write the import script from its template
+                repl_dict = dict(self._repl_dict)
 
-                RegressionTest._replace_in_file(self.result_folder_path / model_import_mos, repl_dict)
+                RegressionTest._materialize("model_import.mos", repl_dict, self._import_mos)
 
-                # Run the import script and write the output of the OpenModelica Compiler (omc) to omc_output
-                os.system(tool_executable + " {} > {}".format(model_import_mos, tool_output))
+                with open(os.path.join(self._result_folder, tool + "_output.txt"), 'wb') as tool_output_file:
+                    # Run the import script and write the output of the OpenModelica Compiler (omc) to omc_output
+                    import_result = subprocess.run([tool_executable, self._import_mos], cwd=self._result_folder,
+                                                   stdout=subprocess.PIPE)
+                    tool_output_file.write(import_result.stdout)
+                    tool_output_file.flush()
 
-                # Read simulation options from the simulation_options_file
-                model_import_output_file = open(tool_output, 'r')
-                omc_messages = model_import_output_file.readlines()
-                model_import_output_file.close()
+                    # Read simulation options from the last line of the captured output of the import script
+                    simulation_options = import_result.stdout.rstrip().rsplit(b'\n', 1)[-1].decode().strip()
 
-                (start_time, stop_time, tolerance, num_intervals, interval) = omc_messages[-1].lstrip('(').rstrip(')').split(',')
+                    (start_time, stop_time, tolerance, num_intervals, interval) = simulation_options.strip('()').split(',')
 
-                # Modify the simulation template
-                if platform.system() == 'Windows':
-                    repl_dict["SIMULATION_BINARY"] = "{}.exe".format(self.model_in_package)
-                elif platform.system() == 'Linux':
-                    repl_dict["SIMULATION_BINARY"] = "./{}".format(self.model_in_package)
-                repl_dict["START_TIME"] = start_time
-                repl_dict["STOP_TIME"] = stop_time
-                repl_dict["TOLERANCE"] = tolerance
-                repl_dict["NUM_INTERVALS"] = num_intervals
+                    # Write the simulation script from its template
+                    if _IS_WINDOWS:
+                        repl_dict["SIMULATION_BINARY"] = "{}.exe".format(self.model_in_package)
+                    elif _IS_LINUX:
+                        repl_dict["SIMULATION_BINARY"] = "./{}".format(self.model_in_package)
+                    repl_dict["START_TIME"] = start_time
+                    repl_dict["STOP_TIME"] = stop_time
+                    repl_dict["TOLERANCE"] = tolerance
+                    repl_dict["NUM_INTERVALS"] = num_intervals
 
-                RegressionTest._replace_in_file(self.result_folder_path / model_simulate_mos, repl_dict)
+                    RegressionTest._materialize("model_simulate.mos", repl_dict, self._simulate_mos)
 
-                # Run the simulation script and append the output of the OpenModelica Compiler (omc) to omc_output
-                os.system(tool_executable + " {} >> {}".format(model_simulate_mos, tool_output))
+                    # Run the simulation script and append the output of the OpenModelica Compiler (omc) to omc_output
+                    subprocess.run([tool_executable, self._simulate_mos], cwd=self._result_folder,
+                                   stdout=tool_output_file)
 
         return
+
+
+def _compare_result_worker(tester, compare_kwargs):
+    """
+    Runs compare_result on a RegressionTest object inside a worker process of RegressionTest.run_many.
+
+    Returns
+    -------
+    out : tuple
+        Tuple (result_folder_created, error) where error is None if the test passed
+    """
+    try:
+        tester.compare_result(**compare_kwargs)
+        error = None
+    except Exception as err:
+        error = err
+
+    return tester.result_folder_created, error